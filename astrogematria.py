@@ -6,7 +6,7 @@ Calculadora de Astrogematría — v3.5
 - Orbes estrictos: 3° (conj/opp/tri/cuad) y 2° (sextil)
 - Regentes clásicos del Asc sobreponderados
 - Luminarias pegan más en Importancia
-- Geocoding (Nominatim) y zona horaria automática (timezonefinder + fallbacks)
+- Geocoding (Nominatim) y zona horaria automática (tzfpy, timezonefinder + fallbacks)
 - ÁNGULOS incluidos: Asc, MC, Desc, IC
   · Contribuyen a IMPORTANCIA (impacto)
   · No suman a CALIDAD (no son planetas)
@@ -17,11 +17,46 @@ from flatlib.datetime import Datetime
 from flatlib.geopos import GeoPos
 from flatlib import const
 
+import csv
+import functools
+import heapq
+import math
+import os
+import sqlite3
+import threading
 import unicodedata
 import re
-from typing import Dict, Tuple
+from dataclasses import dataclass
+from typing import Dict, NamedTuple, Tuple, Union
 from datetime import datetime
 
+# Dependencias opcionales: se importan una vez al cargar el módulo (y no en la
+# primera petición); si faltan, la función correspondiente avisa y devuelve None.
+try:
+    from geopy.geocoders import Nominatim
+    from geopy.adapters import RequestsAdapter
+except ImportError:
+    Nominatim = RequestsAdapter = None
+try:
+    from tzfpy import get_tz
+except ImportError:
+    get_tz = None
+try:
+    from timezonefinder import TimezoneFinder
+except ImportError:
+    TimezoneFinder = None
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    try:
+        from backports.zoneinfo import ZoneInfo
+    except ImportError:
+        ZoneInfo = None
+try:
+    import pytz
+except ImportError:
+    pytz = None
+
 # ==== CONFIGURACIÓN ASTROGEMATRÍA ====
 
 VALORES_ASTROGEMATRIA = {
@@ -40,6 +75,10 @@ ASPECTOS = {
     'sextil':     {'angulo': 60,  'orbe': 4, 'peso': +1}
 }
 
+# (nombre, ángulo, orbe, peso) en el orden de ASPECTOS, para el bucle de evaluación
+_TABLA_ASPECTOS = tuple((nombre, float(cfg['angulo']), float(cfg['orbe']), cfg['peso'])
+                        for nombre, cfg in ASPECTOS.items())
+
 PESO_PLANETA = {
     'Sun': 1.0, 'Moon': 0.9, 'Mercury': 0.7, 'Venus': 1.0, 'Mars': 1.1,
     'Jupiter': 1.0, 'Saturn': 1.15, 'Uranus': 1.0, 'Neptune': 1.0, 'Pluto': 1.0,
@@ -62,6 +101,26 @@ REGENTES_CLASICOS = {
 }
 RULER_MULT = 1.35
 
+# Sistema de casas de la carta (variable de entorno HOUSE_SYSTEM). Asc/MC y
+# planetas no dependen de él; PLACIDUS es el de siempre.
+HOUSE_SYSTEMS = {
+    'PLACIDUS': const.HOUSES_PLACIDUS,
+    'EQUAL':    const.HOUSES_EQUAL,
+}
+_hsys_env = os.getenv("HOUSE_SYSTEM", "PLACIDUS").strip().upper()
+if _hsys_env not in HOUSE_SYSTEMS:
+    raise ValueError(f"HOUSE_SYSTEM='{_hsys_env}' no válido; usa uno de: {', '.join(HOUSE_SYSTEMS)}")
+HOUSE_SYSTEM = HOUSE_SYSTEMS[_hsys_env]
+
+# Listado de la carta en la CLI: orden y nombres en español
+ORDEN_CARTA = ('Sun', 'Moon', 'Mercury', 'Venus', 'Mars', 'Jupiter', 'Saturn',
+               'Uranus', 'Neptune', 'Pluto', 'Asc', 'Desc', 'MC', 'IC')
+NOMBRES_ES = {
+    'Sun':'Sol','Moon':'Luna','Mercury':'Mercurio','Venus':'Venus','Mars':'Marte',
+    'Jupiter':'Júpiter','Saturn':'Saturno','Uranus':'Urano','Neptune':'Neptuno',
+    'Pluto':'Plutón','Asc':'Asc','MC':'MC','Desc':'Desc','IC':'IC'
+}
+
 SIGNOS = ["Aries","Tauro","Géminis","Cáncer","Leo","Virgo",
           "Libra","Escorpio","Sagitario","Capricornio","Acuario","Piscis"]
 
@@ -82,6 +141,16 @@ VALENCE_WEIGHTS = {  # Calidad (firma del aspecto)
     'oposicion': 1.2     # -
 }
 
+# Calidad por aspecto: (peso con signo, ¿usa |valencia del planeta|?)
+# La conjunción toma el signo del planeta; el resto, el del aspecto.
+_VALENCIA_ASPECTO = {
+    'conjuncion': (+VALENCE_WEIGHTS['conjuncion'], False),
+    'trigono':    (+VALENCE_WEIGHTS['trigono'],    True),
+    'sextil':     (+VALENCE_WEIGHTS['sextil'],     True),
+    'cuadratura': (-VALENCE_WEIGHTS['cuadratura'], True),
+    'oposicion':  (-VALENCE_WEIGHTS['oposicion'],  True),
+}
+
 # Naturaleza del planeta para Calidad (–1..+1)
 PLANET_VALENCE = {
     'Jupiter':  +2.0, 'Venus':  +1.5, 'Sun': +1.2, 'Moon': +0.9, 'Mercury': +0.7,
@@ -98,15 +167,40 @@ QUALITY_SCALE = 3.0      # escalar Calidad a –10..+10
 def clamp(x, lo, hi):
     return max(lo, min(hi, x))
 
-def normaliza_termino(s: str) -> str:
-    s = s.replace('ñ', 'Ñ').replace('ç', 'Ç')
+_STRIP_RE = re.compile(r'[^A-Z0-9ÑÇ]')
+_PRE_TRANS = str.maketrans({'ñ': 'Ñ', 'ç': 'Ç'})
+
+def _normaliza_lento(s: str) -> str:
+    s = s.translate(_PRE_TRANS)
     s = ''.join(ch for ch in unicodedata.normalize('NFKD', s)
                 if not unicodedata.combining(ch))
-    s = s.upper()
-    return re.sub(r'[^A-Z0-9ÑÇ]', '', s)
+    return _STRIP_RE.sub('', s.upper())
+
+_NORM_PRECARGA = 0x0250  # Latín básico .. Latín extendido-B
+
+class _TablaNormalizacion(dict):
+    """Tabla para str.translate: carácter -> su forma normalizada (o None).
+    Los caracteres fuera de la tabla precargada se calculan al vuelo sin
+    guardarse, para que la tabla no crezca con lo que manden los clientes."""
+    def __missing__(self, cp: int):
+        v = _normaliza_lento(chr(cp)) or None
+        if cp < _NORM_PRECARGA:
+            self[cp] = v
+        return v
+
+_NORM_TABLE = _TablaNormalizacion()
+for _cp in range(_NORM_PRECARGA):
+    _NORM_TABLE[_cp]
+
+def normaliza_termino(s: str) -> str:
+    return s.translate(_NORM_TABLE)
+
+# Tabla de 256 entradas indexada por byte latin-1 (Ñ=0xD1, Ç=0xC7)
+_VAL_TABLE = tuple(VALORES_ASTROGEMATRIA.get(chr(b), 0) for b in range(256))
 
 def valor_astrogematrico(termino: str) -> int:
-    return sum(VALORES_ASTROGEMATRIA.get(ch, 0) for ch in termino)
+    # Los caracteres fuera de latin-1 no tienen valor: se descartan al codificar
+    return sum(map(_VAL_TABLE.__getitem__, termino.encode('latin-1', 'ignore')))
 
 def grado_astrogematrico(val: int) -> float:
     """Convención invertida, como en la web de ejemplo."""
@@ -146,69 +240,196 @@ def dec_to_flatlib_coord(dec: float, is_lat: bool) -> str:
 
 # ==== GEOCODING ====
 
+# Caché persistente de geocoding (SQLite): "ciudad|país" -> (lat_str, lon_str, lat, lon)
+GEOCACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "geocache.sqlite3")
+
+# Tabla local de ciudades frecuentes (ciudad, país, lat, lon): se consulta antes
+# que cualquier caché o red. Sin offset horario: depende de la fecha (DST).
+CIUDADES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ciudades.csv")
+
+GEOCODER_TIMEOUT = 3  # segundos; si Nominatim no responde, se piden coordenadas
+
+_geocache_local = threading.local()
+
+def _geocache_conn():
+    """Conexión a la caché de geocoding, una por hilo (y por proceso), abierta
+    en el primer uso. En modo WAL varios procesos leen y escriben a la vez.
+    Devuelve None si no se pudo abrir (se sigue sin caché en disco)."""
+    con = getattr(_geocache_local, "con", None)
+    if con is None:
+        try:
+            con = sqlite3.connect(GEOCACHE_PATH, timeout=5)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("CREATE TABLE IF NOT EXISTS geocache ("
+                        "clave TEXT PRIMARY KEY, lat_str TEXT, lon_str TEXT, lat REAL, lon REAL)")
+        except sqlite3.Error as e:
+            print(f"[Aviso] No se pudo abrir la caché de geocoding: {e}")
+            con = False
+        _geocache_local.con = con
+    return con or None
+
+def _clave_lugar(city: str, country: str) -> str:
+    """'ciudad|país' en minúsculas y sin tildes (México == Mexico)."""
+    def limpia(x: str) -> str:
+        x = unicodedata.normalize('NFKD', x.strip().lower())
+        return ''.join(ch for ch in x if not unicodedata.combining(ch))
+    return f"{limpia(city)}|{limpia(country)}"
+
+def _carga_ciudades(path: str) -> Dict[str, Tuple[str, str, float, float]]:
+    tabla = {}
+    try:
+        with open(path, encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                lat = float(row["lat"])
+                lon = float(row["lon"])
+                tabla[_clave_lugar(row["ciudad"], row["pais"])] = (
+                    dec_to_flatlib_coord(lat, is_lat=True),
+                    dec_to_flatlib_coord(lon, is_lat=False),
+                    lat, lon)
+    except Exception as e:
+        print(f"[Aviso] No se pudo cargar la tabla de ciudades: {e}")
+    return tabla
+
+_CIUDADES = _carga_ciudades(CIUDADES_PATH)
+
+_geolocator = None
+_geolocator_lock = threading.Lock()
+
+def _get_geolocator():
+    """Nominatim único por proceso: su sesión de requests mantiene viva la
+    conexión TCP/TLS entre consultas."""
+    global _geolocator
+    if _geolocator is None:
+        with _geolocator_lock:
+            if _geolocator is None:
+                if Nominatim is None:
+                    raise RuntimeError("geopy no está instalado")
+                _geolocator = Nominatim(user_agent="enastrologico_astrogematria/1.0",
+                                        timeout=GEOCODER_TIMEOUT,
+                                        adapter_factory=RequestsAdapter)
+    return _geolocator
+
+@functools.lru_cache(maxsize=1024)
+def _geocode_cached(key: str, q: str) -> Tuple[str, str, float, float]:
+    """Consulta Nominatim (texto q) solo si key (_clave_lugar) no está en la
+    caché en disco, así que México y Mexico comparten entrada y consulta.
+    Lanza LookupError si no hay resultado (así lru_cache no guarda fallos)."""
+    con = _geocache_conn()
+    if con is not None:
+        try:
+            hit = con.execute("SELECT lat_str, lon_str, lat, lon FROM geocache WHERE clave = ?",
+                              (key,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"[Aviso] Caché de geocoding: {e}")
+            hit = None
+        if hit is not None:
+            return hit
+
+    loc = _get_geolocator().geocode(q, language="es")
+    if not loc:
+        raise LookupError(f"sin resultados para '{q}'")
+    lat = float(loc.latitude)
+    lon = float(loc.longitude)
+    lat_str = dec_to_flatlib_coord(lat, is_lat=True)
+    lon_str = dec_to_flatlib_coord(lon, is_lat=False)
+    res = (lat_str, lon_str, lat, lon)
+
+    if con is not None:
+        try:
+            with con:  # commit al salir
+                con.execute("INSERT OR REPLACE INTO geocache VALUES (?, ?, ?, ?, ?)",
+                            (key, *res))
+        except sqlite3.Error as e:
+            print(f"[Aviso] Caché de geocoding: {e}")
+    return res
+
 def geocode_city(city: str, country: str):
+    key = _clave_lugar(city, country)
+    hit = _CIUDADES.get(key)
+    if hit is not None:
+        return hit
     try:
-        from geopy.geocoders import Nominatim
-        geolocator = Nominatim(user_agent="enastrologico_astrogematria/1.0")
-        q = f"{city}, {country}".strip(", ")
-        loc = geolocator.geocode(q, language="es", timeout=10)
-        if not loc:
-            return None
-        lat = float(loc.latitude)
-        lon = float(loc.longitude)
-        lat_str = dec_to_flatlib_coord(lat, is_lat=True)
-        lon_str = dec_to_flatlib_coord(lon, is_lat=False)
-        return (lat_str, lon_str, lat, lon)
+        return _geocode_cached(key, f"{city.strip()}, {country.strip()}".strip(", "))
+    except LookupError:
+        return None
     except Exception as e:
         print(f"[Aviso] Geocoding falló: {e}")
         return None
 
+_HEMI_RE = re.compile(r'[NnSsEeOoWw]$')
+_SPLIT_RE = re.compile(r'[:\s,]+')
+
+def _dms_to_float(s: str) -> float:
+    s = s.strip()
+    # Camino rápido: decimal simple (los no finitos siguen el camino DMS)
+    try:
+        v = float(s)
+    except ValueError:
+        pass
+    else:
+        if math.isfinite(v):
+            return v
+    hemi = None
+    if _HEMI_RE.search(s):
+        hemi = s[-1].upper()
+        s = s[:-1].strip()
+    parts = _SPLIT_RE.split(s)
+    deg = float(parts[0])
+    minutes = float(parts[1]) if len(parts) >= 2 else 0.0
+    seconds = float(parts[2]) if len(parts) >= 3 else 0.0
+    val = abs(deg) + minutes/60 + seconds/3600
+    if hemi in ('S',): val = -val
+    if hemi in ('W','O'): val = -val
+    if str(parts[0]).startswith('-'): val = -val
+    return val
+
 def parse_geopos(user_lat: str, user_lon: str) -> Tuple[str, str, float, float]:
-    def dms_to_float(s: str) -> float:
-        s = s.strip()
-        if re.match(r'^-?\d+(\.\d+)?$', s):
-            return float(s)
-        hemi = None
-        if re.search(r'[NnSsEeOoWw]$', s):
-            hemi = s[-1].upper()
-            s = s[:-1].strip()
-        parts = re.split(r'[:\s,]+', s)
-        deg = float(parts[0])
-        minutes = float(parts[1]) if len(parts) >= 2 else 0.0
-        seconds = float(parts[2]) if len(parts) >= 3 else 0.0
-        val = abs(deg) + minutes/60 + seconds/3600
-        if hemi in ('S',): val = -val
-        if hemi in ('W','O'): val = -val
-        if str(parts[0]).startswith('-'): val = -val
-        return val
-    lat = dms_to_float(user_lat)
-    lon = dms_to_float(user_lon)
+    lat = _dms_to_float(user_lat)
+    lon = _dms_to_float(user_lon)
     lat_str = dec_to_flatlib_coord(lat, is_lat=True)
     lon_str = dec_to_flatlib_coord(lon, is_lat=False)
     return (lat_str, lon_str, lat, lon)
 
 # ==== ZONA HORARIA ====
 
-def tz_offset_from_coords(dt_local: datetime, lat: float, lon: float) -> str:
-    try:
-        from timezonefinder import TimezoneFinder
-        tf = TimezoneFinder()
-        tzname = tf.timezone_at(lng=lon, lat=lat)
-        if not tzname:
-            return None
-    except Exception as e:
-        print(f"[Aviso] timezonefinder falló: {e}")
-        return None
-
+_tf = None
+_tf_lock = threading.Lock()
+
+def _get_tf():
+    """TimezoneFinder único por proceso (cargar sus polígonos es caro)."""
+    global _tf
+    if _tf is None:
+        with _tf_lock:
+            if _tf is None:
+                if TimezoneFinder is None:
+                    raise RuntimeError("ni tzfpy ni timezonefinder están instalados")
+                _tf = TimezoneFinder(in_memory=True)
+    return _tf
+
+@functools.lru_cache(maxsize=4096)
+def _tzname_for(lat_q: float, lon_q: float):
+    """Nombre IANA para coordenadas cuantizadas a 2 decimales (~1 km).
+    tzfpy (índice nativo) si está instalado; si no, timezonefinder."""
+    if get_tz is None:
+        return _get_tf().timezone_at(lng=lon_q, lat=lat_q)
+    return get_tz(lon_q, lat_q)
+
+@functools.lru_cache(maxsize=1024)
+def _zi(tzname: str):
+    if ZoneInfo is None:
+        raise RuntimeError("zoneinfo no disponible")
+    return ZoneInfo(tzname)
+
+@functools.lru_cache(maxsize=8192)
+def _offset_for(tzname: str, dt_local: datetime):
+    """Offset '+HH:MM' de tzname en esa fecha/hora local (la clave es la fecha
+    completa, no el mes: los cambios de horario caen a mitad de mes)."""
     try:
-        try:
-            from zoneinfo import ZoneInfo
-        except Exception:
-            from backports.zoneinfo import ZoneInfo
-        dt_with_tz = dt_local.replace(tzinfo=ZoneInfo(tzname))
+        dt_with_tz = dt_local.replace(tzinfo=_zi(tzname))
     except Exception:
         try:
-            import pytz
+            if pytz is None:
+                raise RuntimeError("pytz no está instalado")
             tz = pytz.timezone(tzname)
             dt_with_tz = tz.localize(dt_local, is_dst=None)
         except Exception as e:
@@ -225,18 +446,60 @@ def tz_offset_from_coords(dt_local: datetime, lat: float, lon: float) -> str:
     mm = total_minutes % 60
     return f"{sign}{hh:02d}:{mm:02d}"
 
+def tz_offset_from_coords(dt_local: datetime, lat: float, lon: float) -> str:
+    try:
+        tzname = _tzname_for(round(lat, 2), round(lon, 2))
+        if not tzname:
+            return None
+    except Exception as e:
+        print(f"[Aviso] Búsqueda de zona horaria falló: {e}")
+        return None
+
+    return _offset_for(tzname, dt_local)
+
+# ==== DATOS DE NACIMIENTO (compartido por CLI y API) ====
+
+def parse_birth_datetime(date: str, time: str) -> datetime:
+    try:
+        # Camino rápido: formato canónico YYYY/MM/DD HH:MM por cortes fijos;
+        # el resto (p. ej. 2000/1/5 o 9:05) sigue pasando por strptime
+        if (len(date) == 10 and len(time) == 5
+                and date[4] == date[7] == '/' and time[2] == ':'
+                and (date[:4] + date[5:7] + date[8:] + time[:2] + time[3:]).isdecimal()):
+            return datetime(int(date[:4]), int(date[5:7]), int(date[8:]),
+                            int(time[:2]), int(time[3:]))
+        return datetime.strptime(f"{date} {time}", "%Y/%m/%d %H:%M")
+    except ValueError:
+        raise ValueError("Fecha/Hora inválidas. Usa YYYY/MM/DD y HH:MM.")
+
+def resolve_coords(city, country, lat, lon) -> Tuple[str, str, float, float, bool]:
+    """Geocoding de city/country; si no hay o falla, lat/lon manuales.
+    Devuelve (lat_str, lon_str, lat, lon, geocodificado).
+    Lanza ValueError si no hay con qué situar el nacimiento."""
+    if city or country:
+        geo = geocode_city(city or "", country or "")
+        if geo:
+            return (*geo, True)
+    if not (lat and lon):
+        raise ValueError("Faltan city/country o lat/lon")
+    return (*parse_geopos(lat, lon), False)
+
+def resolve_tz_offset(date: str, time: str, lat: float, lon: float) -> str:
+    """Offset '+HH:MM' en la fecha/hora local dada, o None si no se puede determinar."""
+    return tz_offset_from_coords(parse_birth_datetime(date, time), lat, lon)
+
 # ==== POSICIONES CARTA ====
 
 def obtener_posiciones(chart: Chart) -> Dict[str, float]:
-    pos = {}
-    for p in PLANETAS_TRAD:
-        pos[p] = chart.get(p).lon
+    # Un solo recorrido de la lista de objetos de flatlib (chart.get la recorre cada vez)
+    lons = {o.id: o.lon for o in chart.objects}
+    pos = {p: lons[p] for p in PLANETAS_TRAD}
     for p in PLANETAS_MOD:
-        try: pos[p] = chart.get(p).lon
-        except Exception: pass
+        if p in lons:
+            pos[p] = lons[p]
     # Ángulos
-    asc = chart.get('Asc').lon
-    mc  = chart.get('MC').lon
+    asc = chart.getAngle('Asc').lon
+    mc  = chart.getAngle('MC').lon
     desc = (asc + 180.0) % 360.0
     ic   = (mc  + 180.0) % 360.0
     pos['Asc']  = asc
@@ -245,84 +508,163 @@ def obtener_posiciones(chart: Chart) -> Dict[str, float]:
     pos['IC']   = ic
     return pos
 
-# ==== EVALUACIÓN (Importancia + Calidad) ====
+# ==== CARTA PREPARADA (multiplicadores por cuerpo) ====
 
-def evalua_termino_con_carta(term: str, posiciones: Dict[str, float]) -> Dict:
-    # 1) Preparación
-    tnorm = normaliza_termino(term)
-    val = valor_astrogematrico(tnorm)
-    grado = grado_astrogematrico(val)
+class CartaPreparada(NamedTuple):
+    """Datos por cuerpo que solo dependen de la carta, alineados por índice."""
+    cuerpos: Tuple[str, ...]
+    lons: Tuple[float, ...]
+    es_angulo: Tuple[bool, ...]
+    imp_mult: Tuple[float, ...]    # multiplicador de Importancia
+    valencia: Tuple[float, ...]    # PLANET_VALENCE (0 en ángulos)
+    ruler_mult: Tuple[float, ...]  # RULER_MULT si es regente del Asc, si no 1
+    peso: Tuple[float, ...]        # PESO_PLANETA
+    regentes: Tuple[str, ...]
 
+def prepara_carta(posiciones: Dict[str, float]) -> CartaPreparada:
     asc_lon = posiciones.get('Asc', 0.0)
     asc_sign = lon_to_sign(asc_lon)
     regentes = set(REGENTES_CLASICOS.get(asc_sign, []))
 
-    detalles = []
+    es_angulo, imp_mult, valencia, ruler_mult, peso = [], [], [], [], []
+    for cuerpo in posiciones:
+        ang = cuerpo in ANGULOS
+        p = PESO_PLANETA.get(cuerpo, 1.0)
+        rm = RULER_MULT if cuerpo in regentes else 1.0
+        if ang:
+            mi = ANGLE_IMPACT_MULT
+        else:
+            mi = p
+            if cuerpo in regentes:
+                mi *= RULER_MULT
+            if cuerpo in LUMINARIES:
+                mi *= LUM_IMPACT_MULT
+        es_angulo.append(ang)
+        imp_mult.append(mi)
+        valencia.append(0.0 if ang else PLANET_VALENCE.get(cuerpo, 0.0))
+        ruler_mult.append(rm)
+        peso.append(p)
+
+    return CartaPreparada(
+        cuerpos=tuple(posiciones),
+        lons=tuple(posiciones.values()),
+        es_angulo=tuple(es_angulo),
+        imp_mult=tuple(imp_mult),
+        valencia=tuple(valencia),
+        ruler_mult=tuple(ruler_mult),
+        peso=tuple(peso),
+        regentes=tuple(sorted(regentes)),
+    )
+
+@functools.lru_cache(maxsize=512)
+def _mk_dt(date: str, time: str, zona: str) -> Datetime:
+    return Datetime(date, time, zona)
+
+@functools.lru_cache(maxsize=512)
+def _mk_geopos(lat_str: str, lon_str: str) -> GeoPos:
+    return GeoPos(lat_str, lon_str)
+
+@functools.lru_cache(maxsize=1024)
+def carta_natal(date: str, time: str, zona: str, lat_str: str, lon_str: str) -> CartaPreparada:
+    """Carta natal preparada, cacheada por nacimiento ya situado (fecha, hora,
+    offset y coordenadas flatlib). Compartida por CLI, API y precalentamiento."""
+    chart = Chart(_mk_dt(date, time, zona), _mk_geopos(lat_str, lon_str),
+                  hsys=HOUSE_SYSTEM)
+    return prepara_carta(obtener_posiciones(chart))
+
+def limpia_caches():
+    """Vacía las cachés en memoria del proceso (la de geocoding en disco se conserva)."""
+    for fn in (carta_natal, _mk_dt, _mk_geopos, _geocode_cached,
+               _tzname_for, _zi, _offset_for):
+        fn.cache_clear()
+
+# ==== EVALUACIÓN (Importancia + Calidad) ====
+
+@dataclass(slots=True)
+class Hit:
+    """Aspecto del término con un cuerpo de la carta (detalle del resultado)."""
+    cuerpo: str
+    es_angulo: bool
+    aspecto: str
+    orb: float
+    impacto: float
+    calidad: float
+    lon_cuerpo: float
+
+def _nucleo_evaluacion(grado: float, carta: CartaPreparada):
+    """Parte numérica de la evaluación: mejor aspecto de cada cuerpo con el grado.
+    Devuelve (hits, import_sum, quality_sum, has_conj), con
+    hits = [(i, aspecto, delta, impacto, calidad), ...] en el orden de la carta."""
+    hits = []
     import_sum = 0.0   # Importancia (módulo)
     quality_sum = 0.0  # Calidad (con signo)
-    has_aspect = False
-    has_conj   = False
-
-    # 2) Recorremos planetas y ángulos
-    for cuerpo, lon in posiciones.items():
-        nombre, delta, _peso_tmp = mejor_aspecto(grado, lon)
+    has_conj = False
+
+    # (solo se recorren longitudes; los multiplicadores se indexan si hay aspecto)
+    for i, lon in enumerate(carta.lons):
+        # Mejor aspecto (como mejor_aspecto, con la distancia calculada una vez);
+        # dist_angular en línea, sin llamada por cuerpo
+        d0 = abs((grado - lon + 540.0) % 360.0 - 180.0)
+        nombre = ''
+        best = 0.0
+        for asp, angulo, orbe, peso in _TABLA_ASPECTOS:
+            dl = abs(d0 - angulo)
+            if dl <= orbe:
+                of = 1.0 - dl / orbe
+                w = abs(peso * of)
+                if w > best:
+                    nombre, delta, orb_factor, best = asp, dl, of, w
         if not nombre:
             continue
 
-        has_aspect = True
         if nombre == 'conjuncion':
             has_conj = True
 
-        # Orb factor (0..1)
-        orbe = ASPECTOS[nombre]['orbe']
-        orb_factor = atenuado_por_orbe(delta, orbe)
-        if orb_factor <= 0:
-            continue
-
-        es_angulo = cuerpo in ANGULOS
+        # Importancia (módulo)
+        imp = abs(IMPACT_WEIGHTS[nombre] * orb_factor * carta.imp_mult[i])
+        import_sum += imp
 
-        # Multiplicadores para Importancia
-        if es_angulo:
-            mult_imp = ANGLE_IMPACT_MULT
+        # Calidad (con signo) — solo para PLANETAS
+        if carta.es_angulo[i]:
+            q = 0.0
         else:
-            mult_imp = PESO_PLANETA.get(cuerpo, 1.0)
-            if cuerpo in regentes:
-                mult_imp *= RULER_MULT
-            if cuerpo in LUMINARIES:
-                mult_imp *= LUM_IMPACT_MULT
-
-        # 2.a) Importancia (módulo)
-        imp = IMPACT_WEIGHTS[nombre] * orb_factor * mult_imp
-        import_sum += abs(imp)
-
-        # 2.b) Calidad (con signo) — solo para PLANETAS
-        if not es_angulo:
-            pv = PLANET_VALENCE.get(cuerpo, 0.0)
-            if nombre == 'conjuncion':
-                q = VALENCE_WEIGHTS[nombre] * orb_factor * pv
-            elif nombre in ('trigono', 'sextil'):
-                q = VALENCE_WEIGHTS[nombre] * orb_factor * abs(pv)
-            else:  # cuadratura / oposición
-                q = -VALENCE_WEIGHTS[nombre] * orb_factor * abs(pv)
+            pv = carta.valencia[i]
+            w_signo, usa_abs = _VALENCIA_ASPECTO[nombre]
+            q = w_signo * orb_factor * (abs(pv) if usa_abs else pv)
+            q *= carta.ruler_mult[i]
+            q *= carta.peso[i]
+            quality_sum += q
 
-            if cuerpo in regentes:
-                q *= RULER_MULT
-            q *= PESO_PLANETA.get(cuerpo, 1.0)
+        hits.append((i, nombre, delta, imp, q))
 
-            quality_sum += q
-            calidad_det = round(q, 3)
-        else:
-            calidad_det = 0.0  # los ángulos no aportan calidad
-
-        detalles.append({
-            'cuerpo': cuerpo,
-            'es_angulo': es_angulo,
-            'aspecto': nombre,
-            'orb': round(delta, 2),
-            'impacto': round(abs(imp), 3),
-            'calidad': calidad_det,
-            'lon_cuerpo': round(lon, 2)
-        })
+    return hits, import_sum, quality_sum, has_conj
+
+def evalua_termino_con_carta(term: str,
+                             posiciones: Union[Dict[str, float], CartaPreparada]) -> Dict:
+    # 1) Preparación
+    tnorm = normaliza_termino(term)
+    val = valor_astrogematrico(tnorm)
+    grado = grado_astrogematrico(val)
+
+    # Se puede pasar la carta ya preparada para evaluar muchos términos
+    carta = posiciones if isinstance(posiciones, CartaPreparada) else prepara_carta(posiciones)
+
+    # 2) Recorremos planetas y ángulos
+    hits, import_sum, quality_sum, has_conj = _nucleo_evaluacion(grado, carta)
+    has_aspect = bool(hits)
+
+    # Top 8 por Importancia y luego por |Calidad| (con los valores redondeados
+    # que se muestran); solo se crean los Hit de los elegidos
+    top = heapq.nsmallest(8, hits, key=lambda h: (-round(h[3], 3), -abs(round(h[4], 3))))
+    detalles = [Hit(
+        cuerpo=carta.cuerpos[i],
+        es_angulo=carta.es_angulo[i],
+        aspecto=nombre,
+        orb=round(delta, 2),
+        impacto=round(imp, 3),
+        calidad=round(q, 3),  # los ángulos no aportan calidad (0.0)
+        lon_cuerpo=round(carta.lons[i], 2)
+    ) for i, nombre, delta, imp, q in top]
 
     # 3) Etiquetas y escalas
     if not has_aspect:
@@ -352,9 +694,6 @@ def evalua_termino_con_carta(term: str, posiciones: Dict[str, float]) -> Dict:
         else:
             etq_calidad = "MIXTO / AMBIVALENTE"
 
-    # Ordenamos impactos por Importancia y luego por |Calidad|
-    detalles = sorted(detalles, key=lambda d: (-d['impacto'], -abs(d['calidad'])))[:8]
-
     # Info de signo y grado dentro del signo
     signo_idx = int(grado // 30)
     grado_en_signo = round(grado % 30, 2)
@@ -373,10 +712,20 @@ def evalua_termino_con_carta(term: str, posiciones: Dict[str, float]) -> Dict:
         'calidad': round(calidad, 1),
         'etq_calidad': etq_calidad,
 
-        'regentes_asc': sorted(list(regentes)),
+        'regentes_asc': list(carta.regentes),
         'hits': detalles
     }
 
+# ==== PRECALENTAMIENTO ====
+
+def precalienta():
+    """Paga al arrancar los costes de primera llamada: índice de zonas horarias,
+    ZoneInfo, efemérides de flatlib y la ruta de evaluación."""
+    _tzname_for(40.42, -3.7)
+    _zi("UTC")
+    carta = carta_natal("2000/01/01", "12:00", "+00:00", "40n25", "3w42")
+    evalua_termino_con_carta("astrogematria", carta)
+
 # ==== ENTRADA Y CLI ====
 
 def pedir_datos():
@@ -404,13 +753,8 @@ def pedir_datos():
         u_lon = input("Longitud: ").strip()
         lat_str, lon_str, lat_f, lon_f = parse_geopos(u_lat, u_lon)
 
-    try:
-        dt_local = datetime.strptime(f"{fecha} {hora}", "%Y/%m/%d %H:%M")
-    except ValueError:
-        raise ValueError("Formato de fecha/hora inválido. Usa YYYY/MM/DD y HH:MM.")
-
     print("[Info] Calculando zona horaria…", flush=True)
-    zona = tz_offset_from_coords(dt_local, lat_f, lon_f)
+    zona = resolve_tz_offset(fecha, hora, lat_f, lon_f)
     if zona is None:
         print("[Aviso] No se pudo determinar la zona automáticamente.")
         zona = input("Indica el offset (ej +01:00 para España): ").strip()
@@ -425,21 +769,13 @@ def main():
     fecha, hora, zona, lat_str, lon_str = pedir_datos()
 
     print("\nCalculando carta natal…")
-    dt  = Datetime(fecha, hora, zona)
-    pos = GeoPos(lat_str, lon_str)
-    chart = Chart(dt, pos, hsys=const.HOUSES_PLACIDUS)
-    posiciones = obtener_posiciones(chart)
-
-    trad_names = {
-        'Sun':'Sol','Moon':'Luna','Mercury':'Mercurio','Venus':'Venus','Mars':'Marte',
-        'Jupiter':'Júpiter','Saturn':'Saturno','Uranus':'Urano','Neptune':'Neptuno',
-        'Pluto':'Plutón','Asc':'Asc','MC':'MC','Desc':'Desc','IC':'IC'
-    }
+    carta = carta_natal(fecha, hora, zona, lat_str, lon_str)
+    posiciones = dict(zip(carta.cuerpos, carta.lons))
 
     print("\n=== CARTA NATAL (longitudes) ===")
-    for k in ['Sun','Moon','Mercury','Venus','Mars','Jupiter','Saturn','Uranus','Neptune','Pluto','Asc','Desc','MC','IC']:
+    for k in ORDEN_CARTA:
         if k in posiciones:
-            print(f"{trad_names.get(k,k):12}: {posiciones[k]:6.2f}°")
+            print(f"{NOMBRES_ES[k]:12}: {posiciones[k]:6.2f}°")
 
     while True:
         print("\n" + "=" * 60)
@@ -449,7 +785,7 @@ def main():
         if not term:
             continue
 
-        res = evalua_termino_con_carta(term, posiciones)
+        res = evalua_termino_con_carta(term, carta)
         print("\n=== RESULTADO ===")
         print(f"Término normalizado : {res['termino']}")
         print(f"Valor astrogemátrico: {res['valor_astrogematrico']}")
@@ -468,10 +804,10 @@ def main():
         else:
             print("\nTop impactos (por importancia):")
             for h in res['hits']:
-                tipo = "ángulo" if h['es_angulo'] else "planeta"
-                signo = "+" if h['calidad'] > 0 else ""
-                print(f"  {h['cuerpo']:8} ({tipo})  {h['aspecto']:11} (orb {h['orb']:>4.1f}°)  "
-                      f"Impacto {h['impacto']:>4.2f}  |  Calidad {signo}{h['calidad']:>4.2f}")
+                tipo = "ángulo" if h.es_angulo else "planeta"
+                signo = "+" if h.calidad > 0 else ""
+                print(f"  {h.cuerpo:8} ({tipo})  {h.aspecto:11} (orb {h.orb:>4.1f}°)  "
+                      f"Impacto {h.impacto:>4.2f}  |  Calidad {signo}{h.calidad:>4.2f}")
 
 if __name__ == "__main__":
     try:
@@ -1,31 +1,96 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from datetime import datetime
+import asyncio
+import hashlib
+import os
+import re
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Annotated
+
+import orjson
+import ormsgpack
+from fastapi import FastAPI, HTTPException, Request, Response
+from pydantic import BaseModel, Field, ValidationInfo, field_validator, model_validator
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException as StarletteHTTPException
 
-from flatlib.chart import Chart
-from flatlib.datetime import Datetime
-from flatlib.geopos import GeoPos
-from flatlib import const
-
+import astrogematria
 from astrogematria import (
-    geocode_city,
-    parse_geopos,
-    tz_offset_from_coords,
-    obtener_posiciones,
-    evalua_termino_con_carta
+    HOUSE_SYSTEM,
+    CIUDADES_PATH,
+    parse_birth_datetime,
+    _dms_to_float,
+    resolve_coords,
+    resolve_tz_offset,
+    carta_natal,
+    limpia_caches,
+    evalua_termino_con_carta,
+    precalienta,
+    Hit
 )
 
 # ==================== CONFIG ====================
 
-# En pruebas: "*". En producción: pon tu dominio
-ALLOW_ORIGINS = ["*"]
+# Orígenes permitidos (con credenciales no vale "*"): los dominios de
+# producción solo por https; en local, http o https con cualquier puerto
+# (localhost, 127.0.0.1 de Live Server y similares, almudenacuervo.local).
+# En pruebas se puede volver a ALLOW_ORIGINS = ["*"].
+ALLOW_ORIGINS = []
+ALLOW_ORIGIN_REGEX = (
+    r"^(https?://(localhost|127\.0\.0\.1|almudenacuervo\.local)(:\d+)?"
+    r"|https://(www\.)?(vivirenastrologico|enastrologico)\.com)$"
+)
+
+# Máximo de términos por petición en /evaluate_batch
+MAX_BATCH_TERMS = 100
+# Token para los endpoints /admin (cabecera X-Admin-Token); sin él no se registran
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# Longitud máxima de cada término (se evalúa en el bucle de eventos)
+MAX_TERM_LENGTH = 200
+# A partir de cuántos términos se responde en streaming (~50 KB de JSON)
+BATCH_STREAM_MIN_TERMS = 25
+# Versión de la API: subirla invalida los ETag si cambia la forma o el cálculo
+# de las respuestas sin tocar astrogematria.py (p. ej. al actualizar flatlib)
+API_VERSION = "1"
+# Con ETag el cliente guarda la respuesta pero la revalida siempre (If-None-Match)
+CACHE_CONTROL = "private, no-cache"
+
+# Alternativa binaria a JSON para clientes de mucho volumen (Accept)
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+# Documentación OpenAPI: MessagePack además del JSON del response_model, y 304
+_RESPUESTAS = {
+    200: {"content": {MSGPACK_MEDIA_TYPE: {}}},
+    304: {"description": "If-None-Match coincide con el ETag: el cliente ya tiene "
+                         "la respuesta (contrato propio; no es el 412 de RFC 9110 para POST)"},
+}
+
+# Pool para el cálculo de la carta (CPU); el geocoding (red) va al threadpool de Starlette
+_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+@asynccontextmanager
+async def lifespan(app):
+    # Que la primera petición no pague imports, polígonos ni efemérides
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(_POOL, precalienta)
+    except Exception as e:
+        print(f"[Aviso] Precalentamiento falló: {e}")
+    yield
+
+app = FastAPI(title="Astrogematría API", lifespan=lifespan)
 
-app = FastAPI(title="Astrogematría API")
+# Comprime respuestas a partir de 1 KB (las de /evaluate_batch sobre todo)
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
+# CORS se añade el último para quedar como middleware más externo: los
+# preflight OPTIONS se responden sin pasar por nada más
 app.add_middleware(
     CORSMiddleware,
     allow_origins=ALLOW_ORIGINS,
+    allow_origin_regex=ALLOW_ORIGIN_REGEX,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -33,6 +98,15 @@ app.add_middleware(
 
 # ==================== MODELOS ====================
 
+# Formatos aceptados (los mismos que ya admitían strptime y parse_geopos):
+# fallan en la validación, antes de geocoding o zona horaria, igual que las
+# fechas imposibles y las coordenadas fuera de rango
+_DATE_RE = re.compile(r'^\d{4}/\d{1,2}/\d{1,2}$')
+_TIME_RE = re.compile(r'^\d{1,2}:\d{1,2}$')
+_COORD_RE = re.compile(
+    r'^\s*[-+]?(\d+(\.\d*)?|\.\d+)([:\s,]+(\d+(\.\d*)?|\.\d+)){0,2}\s*[NnSsEeOoWw]?\s*$'
+)
+
 class Birth(BaseModel):
     date: str      # YYYY/MM/DD
     time: str      # HH:MM
@@ -41,9 +115,108 @@ class Birth(BaseModel):
     lat: str | None = None
     lon: str | None = None
 
+    @field_validator('date')
+    @classmethod
+    def _check_date(cls, v):
+        if not _DATE_RE.match(v):
+            raise ValueError("Fecha inválida. Usa YYYY/MM/DD.")
+        return v
+
+    @field_validator('time')
+    @classmethod
+    def _check_time(cls, v):
+        if not _TIME_RE.match(v):
+            raise ValueError("Hora inválida. Usa HH:MM.")
+        return v
+
+    @field_validator('lat', 'lon')
+    @classmethod
+    def _check_coord(cls, v, info: ValidationInfo):
+        # En blanco = no indicada (se usará city/country)
+        if v is None or not v.strip():
+            return None
+        if not _COORD_RE.match(v):
+            raise ValueError("Coordenada inválida. Usa decimal (40.418) o DMS (40 25 N).")
+        limite = 90.0 if info.field_name == 'lat' else 180.0
+        if not abs(_dms_to_float(v)) <= limite:
+            raise ValueError(f"Coordenada fuera de rango (±{limite:g}°).")
+        return v
+
+    @model_validator(mode='after')
+    def _check_fecha(self):
+        # Fechas con formato válido pero imposibles (1985/02/30, 25:00)
+        parse_birth_datetime(self.date, self.time)
+        return self
+
+Term = Annotated[str, Field(max_length=MAX_TERM_LENGTH)]
+
 class EvalRequest(BaseModel):
     birth: Birth
+    term: Term
+
+class EvalResult(BaseModel):
+    termino: str
+    valor_astrogematrico: int
+    grado_ecliptico: float
+    signo: str
+    grado_en_signo: float
+    importancia: float
+    etq_importancia: str
+    calidad: float
+    etq_calidad: str
+    regentes_asc: list[str]
+    hits: list[Hit]
+
+class EvalResponse(BaseModel):
+    zone: str
+    lat: str
+    lon: str
+    positions: dict[str, float]
+    result: EvalResult
+
+class EvalBatchRequest(BaseModel):
+    birth: Birth
+    terms: list[Term]
+
+class TermResult(BaseModel):
     term: str
+    result: EvalResult
+
+class EvalBatchResponse(BaseModel):
+    zone: str
+    lat: str
+    lon: str
+    positions: dict[str, float]
+    results: list[TermResult]
+
+# ==================== NACIMIENTO ====================
+
+def _resolve_birth(date, time, city, country, lat, lon):
+    """Coordenadas (geocoding o manuales) y zona horaria de un nacimiento.
+    Puede esperar a la red. Devuelve (zona, lat_str, lon_str, exacto); exacto
+    es False si se usaron lat/lon manuales porque falló el geocoding de
+    city/country, o el "+01:00" por defecto.
+    Sin caché propia: geocoding (que no guarda fallos) y zona horaria ya se
+    cachean por debajo, así que un fallo de red se reintenta en la siguiente."""
+    try:
+        lat_str, lon_str, lat_f, lon_f, geocodificado = resolve_coords(city, country, lat, lon)
+        zona = resolve_tz_offset(date, time, lat_f, lon_f)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    exacto = zona is not None and (geocodificado or not (city or country))
+    return zona or "+01:00", lat_str, lon_str, exacto
+
+# ==================== ERRORES ====================
+
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request, exc):
+    # Mismo cuerpo que el manejador por defecto ({"detail": ...}), vía orjson
+    return Response(
+        content=orjson.dumps({"detail": exc.detail}),
+        status_code=exc.status_code,
+        media_type="application/json",
+        headers=getattr(exc, "headers", None),
+    )
 
 # ==================== ENDPOINTS ====================
 
@@ -51,64 +224,161 @@ class EvalRequest(BaseModel):
 def healthz():
     return {"ok": True}
 
-@app.post("/evaluate")
-def evaluate(req: EvalRequest):
-    # 1. Geocoding
-    lat_str = lon_str = None
-    lat_f = lon_f = None
-
-    if req.birth.city or req.birth.country:
-        geo = geocode_city(req.birth.city or "", req.birth.country or "")
-        if geo:
-            lat_str, lon_str, lat_f, lon_f = geo
-
-    if not lat_str:
-        if not (req.birth.lat and req.birth.lon):
-            raise HTTPException(400, "Faltan city/country o lat/lon")
-        lat_str, lon_str, lat_f, lon_f = parse_geopos(req.birth.lat, req.birth.lon)
-
-    # 2. Fecha y hora
-    try:
-        dt_local = datetime.strptime(
-            f"{req.birth.date} {req.birth.time}",
-            "%Y/%m/%d %H:%M"
-        )
-    except ValueError:
-        raise HTTPException(
-            400,
-            "Fecha/Hora inválidas. Usa YYYY/MM/DD y HH:MM."
-        )
-
-    # 3. Zona horaria
-    zona = tz_offset_from_coords(dt_local, lat_f, lon_f) or "+01:00"
-
-    # 4. Carta natal
-    dt = Datetime(req.birth.date, req.birth.time, zona)
-    pos = GeoPos(lat_str, lon_str)
-    chart = Chart(dt, pos, hsys=const.HOUSES_PLACIDUS)
-    posiciones = obtener_posiciones(chart)
-
-    # 5. Evaluación
-    res = evalua_termino_con_carta(req.term, posiciones)
-
-    return {
+if ADMIN_TOKEN:
+    @app.post("/admin/cache/clear", include_in_schema=False)
+    def admin_cache_clear(request: Request):
+        # Depuración: vacía las cachés en memoria del proceso que atiende la
+        # petición (con varios workers, solo de ese)
+        token = request.headers.get("x-admin-token", "")
+        if not secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            raise HTTPException(403, "Token de administración inválido")
+        limpia_caches()
+        return {"ok": True}
+
+def _quiere_msgpack(request: Request) -> bool:
+    return MSGPACK_MEDIA_TYPE in request.headers.get("accept", "")
+
+def _json(payload, headers=None, msgpack=False) -> Response:
+    # Forma fija y tipos primitivos/dataclass: orjson (u ormsgpack) directo, sin
+    # pasar por la validación del response_model (que queda solo para la documentación)
+    if msgpack:
+        return Response(content=ormsgpack.packb(payload), media_type=MSGPACK_MEDIA_TYPE,
+                        headers=headers)
+    return Response(content=orjson.dumps(payload), media_type="application/json",
+                    headers=headers)
+
+def _huella_version() -> bytes:
+    """Parte del ETag que no depende de la petición: cambia con API_VERSION, el
+    sistema de casas, el código del servidor y del cálculo (pesos, orbes, zona
+    horaria, geocoding) y la tabla de ciudades."""
+    h = hashlib.blake2b(f"{API_VERSION}|{HOUSE_SYSTEM}".encode(), digest_size=16)
+    for path in (__file__, astrogematria.__file__, CIUDADES_PATH):
+        try:
+            with open(path, "rb") as f:
+                h.update(f.read())
+        except OSError as e:
+            print(f"[Aviso] ETag sin huella de {path}: {e}")
+    return h.digest()
+
+_HUELLA_VERSION = _huella_version()
+
+def _cache_headers(req: BaseModel, msgpack=False) -> dict:
+    """ETag (BLAKE2b-128 de la versión, del cuerpo normalizado y del formato)
+    y Cache-Control."""
+    h = hashlib.blake2b(_HUELLA_VERSION, digest_size=16)
+    h.update(orjson.dumps(req.model_dump()))
+    if msgpack:
+        h.update(MSGPACK_MEDIA_TYPE.encode())
+    return {"ETag": f'"{h.hexdigest()}"', "Cache-Control": CACHE_CONTROL, "Vary": "Accept"}
+
+# Respuestas calculadas con un valor de reserva: sin ETag y sin guardarse, para
+# que la siguiente petición vuelva a intentar el geocoding o la zona horaria
+_SIN_CACHE = {"Cache-Control": "no-store", "Vary": "Accept"}
+
+def _no_modificado(request: Request, headers: dict) -> Response | None:
+    """304 sin cuerpo si el cliente ya tiene esta respuesta (If-None-Match).
+    Contrato propio de esta API: para un POST, RFC 9110 (13.1.2) pide 412; aquí
+    se responde 304 para que el cliente reutilice la copia que ya tiene."""
+    inm = request.headers.get("if-none-match")
+    if inm and (inm.strip() == "*" or headers["ETag"] in (t.strip() for t in inm.split(","))):
+        return Response(status_code=304, headers=headers)
+    return None
+
+def _stream_batch(carta, zona, lat_str, lon_str, terms):
+    """Mismo JSON que /evaluate_batch, emitido término a término con orjson.
+    Es un generador síncrono: Starlette lo consume en su threadpool."""
+    head = orjson.dumps({
         "zone": zona,
         "lat": lat_str,
         "lon": lon_str,
-        "positions": posiciones,
+        "positions": dict(zip(carta.cuerpos, carta.lons)),
+    })
+    yield head[:-1] + b',"results":['
+    for k, t in enumerate(terms):
+        if k:
+            yield b','
+        yield orjson.dumps({"term": t, "result": evalua_termino_con_carta(t, carta)})
+    yield b']}'
+
+async def _carta_para(b: Birth):
+    """(carta, zona, lat_str, lon_str, exacto): situación en el threadpool de
+    E/S y cálculo de la carta en el pool de CPU."""
+    zona, lat_str, lon_str, exacto = await run_in_threadpool(
+        _resolve_birth, b.date, b.time, b.city, b.country, b.lat, b.lon
+    )
+    loop = asyncio.get_running_loop()
+    carta = await loop.run_in_executor(
+        _POOL, carta_natal, b.date, b.time, zona, lat_str, lon_str
+    )
+    return carta, zona, lat_str, lon_str, exacto
+
+@app.post("/evaluate", response_model=EvalResponse, responses=_RESPUESTAS)
+async def evaluate(req: EvalRequest, request: Request):
+    msgpack = _quiere_msgpack(request)
+    headers = _cache_headers(req, msgpack)
+    if (r := _no_modificado(request, headers)) is not None:
+        return r
+
+    carta, zona, lat_str, lon_str, exacto = await _carta_para(req.birth)
+    if not exacto:
+        headers = _SIN_CACHE
+
+    # Evaluación
+    res = evalua_termino_con_carta(req.term, carta)
+
+    return _json({
+        "zone": zona,
+        "lat": lat_str,
+        "lon": lon_str,
+        "positions": dict(zip(carta.cuerpos, carta.lons)),
         "result": res
-    }
-
-
-
-
-
-
-
-
-
-
-
-
-
+    }, headers, msgpack)
+
+@app.post("/evaluate_batch", response_model=EvalBatchResponse, responses=_RESPUESTAS)
+async def evaluate_batch(req: EvalBatchRequest, request: Request):
+    if len(req.terms) > MAX_BATCH_TERMS:
+        raise HTTPException(400, f"Máximo {MAX_BATCH_TERMS} términos por petición")
+
+    msgpack = _quiere_msgpack(request)
+    headers = _cache_headers(req, msgpack)
+    if (r := _no_modificado(request, headers)) is not None:
+        return r
+
+    # Una sola carta para todos los términos
+    carta, zona, lat_str, lon_str, exacto = await _carta_para(req.birth)
+    if not exacto:
+        headers = _SIN_CACHE
+
+    # El streaming solo se hace en JSON; MessagePack va siempre en una pieza
+    if not msgpack and len(req.terms) >= BATCH_STREAM_MIN_TERMS:
+        return StreamingResponse(
+            _stream_batch(carta, zona, lat_str, lon_str, req.terms),
+            media_type="application/json",
+            headers=headers,
+        )
 
+    return _json({
+        "zone": zona,
+        "lat": lat_str,
+        "lon": lon_str,
+        "positions": dict(zip(carta.cuerpos, carta.lons)),
+        "results": [
+            {"term": t, "result": evalua_termino_con_carta(t, carta)}
+            for t in req.terms
+        ]
+    }, headers, msgpack)
+
+if __name__ == "__main__":
+    import uvicorn
+    # Varios procesos para repartir el cálculo de cartas; cada uno tiene sus
+    # propias cachés en memoria (la de geocoding en SQLite es compartida).
+    # "auto" usa uvloop/httptools si están instalados (no en Windows)
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", "2")),
+        loop="auto",
+        http="auto",
+        log_level="info",
+    )